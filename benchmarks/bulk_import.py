@@ -0,0 +1,56 @@
+"""
+Loads a generated dump of ROWS people (default 1,000,000) with `flask bulk-import`
+
+    $ pipenv run python benchmarks/bulk_import.py [rows] [json|ndjson|csv]
+
+It uses DATABASE_URL when it is set (the people table must exist, run `pipenv run upgrade`),
+otherwise a fresh SQLite database in a temporary folder.
+"""
+import os
+import sys
+import csv
+import json
+import time
+import tempfile
+
+ROWS = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+FORMAT = sys.argv[2] if len(sys.argv) > 2 else 'ndjson'
+
+workdir = tempfile.mkdtemp(prefix='bulk_import_')
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(workdir, 'benchmark.db'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from app import app  # noqa: E402
+from models import db  # noqa: E402
+
+
+def person(index):
+    return {"name": f"Clone trooper CT-{index:07d}", "height": "183", "mass": "78.2",
+            "hair_color": "black", "eye_color": "brown", "birth_year": "32BBY", "gender": "male"}
+
+
+def write_dump(path):
+    with open(path, 'w', newline='') as dump:
+        if FORMAT == 'csv':
+            writer = csv.DictWriter(dump, fieldnames=list(person(0)))
+            writer.writeheader()
+            writer.writerows(person(index) for index in range(ROWS))
+        elif FORMAT == 'ndjson':
+            for index in range(ROWS):
+                dump.write(json.dumps(person(index)) + "\n")
+        else:
+            dump.write("[\n" + ",\n".join(json.dumps(person(index)) for index in range(ROWS)) + "\n]")
+
+
+if __name__ == '__main__':
+    path = os.path.join(workdir, f"people.{FORMAT}")
+    write_dump(path)
+    print(f"{ROWS:,} rows, {os.path.getsize(path) / 1e6:.0f} MB dump at {path}")
+
+    with app.app_context():
+        db.create_all()
+
+    started = time.perf_counter()
+    result = app.test_cli_runner().invoke(args=['bulk-import', 'people', path, '--format', FORMAT])
+    elapsed = time.perf_counter() - started
+    print(result.output.splitlines()[-1] if result.output else result.exception)
+    print(f"end to end: {elapsed:.1f}s, {ROWS / elapsed:,.0f} rows/s")
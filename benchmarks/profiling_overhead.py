@@ -0,0 +1,64 @@
+"""
+Measures the per-request cost of the profiling hook in src/profiling.py
+
+    $ pipenv run python benchmarks/profiling_overhead.py
+
+It compares an app without the hook, with the hook disabled (the default) and with
+the hook enabled but the request not selected (PROFILE_SECRET set, no signature).
+"""
+import os
+import sys
+import timeit
+from flask import Flask, jsonify
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from profiling import setup_profiling  # noqa: E402
+
+REQUESTS = 2000
+REPEAT = 15
+
+
+def make_app(profiling_env=None):
+    app = Flask(__name__)
+
+    @app.route('/people/<int:people_id>')
+    def get_person(people_id):
+        return jsonify({"id": people_id, "name": "Luke Skywalker"}), 200
+
+    if profiling_env is not None:
+        saved = {key: os.environ.get(key) for key in profiling_env}
+        os.environ.update(profiling_env)
+        try:
+            setup_profiling(app)
+        finally:
+            for key, value in saved.items():
+                if value is None:
+                    os.environ.pop(key, None)
+                else:
+                    os.environ[key] = value
+    return app
+
+
+def per_request_us(clients):
+    """Best time per request of each client, interleaving the runs so that noise hits all of them"""
+    best = [float('inf')] * len(clients)
+    for _ in range(REPEAT):
+        for index, client in enumerate(clients):
+            elapsed = timeit.timeit(lambda: client.get('/people/1'), number=REQUESTS)
+            best[index] = min(best[index], elapsed / REQUESTS * 1e6)
+    return best
+
+
+if __name__ == '__main__':
+    scenarios = [
+        ("no hook", make_app()),
+        ("hook disabled", make_app({'PROFILE_SAMPLE_RATE': '0'})),
+        ("hook enabled, not sampled", make_app({'PROFILE_SECRET': 'benchmark'})),
+    ]
+    clients = [app.test_client() for _, app in scenarios]
+    for client in clients:
+        client.get('/people/1')
+
+    costs = per_request_us(clients)
+    for (label, _), cost in zip(scenarios, costs):
+        print(f"{label:<28} {cost:8.1f} us/request  ({(cost - costs[0]) / costs[0] * 100:+.1f}%)")
@@ -0,0 +1,94 @@
+"""
+Overloads a small app with concurrent clients and reports the latency of the requests
+that were served, with and without the admission control of src/ratelimit.py
+
+    $ pipenv run python benchmarks/ratelimit_stress.py
+
+The /people route holds one of POOL_SIZE "database connections" for SERVICE_TIME, like a
+full-table read would. Without admission control the excess clients queue for the pool
+and the tail latency grows with the load; with it they get a 503/429 right away and the
+served requests keep a latency close to SERVICE_TIME.
+"""
+import os
+import sys
+import time
+import threading
+from collections import Counter
+from flask import Flask, jsonify
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from ratelimit import setup_rate_limiting  # noqa: E402
+
+CLIENTS = 64
+DURATION = 5.0
+POOL_SIZE = 4
+SERVICE_TIME = 0.02
+
+
+def make_app(limited):
+    app = Flask(__name__)
+    pool = threading.Semaphore(POOL_SIZE)
+
+    @app.route('/people')
+    def get_all_people():
+        with pool:
+            time.sleep(SERVICE_TIME)
+        return jsonify([]), 200
+
+    settings = {
+        'RATE_LIMIT_RATE': '50' if limited else '0',
+        'RATE_LIMIT_BURST': '100',
+        'RATE_LIMIT_COST_LIST': '1',
+        'RATE_LIMIT_CONCURRENCY': str(POOL_SIZE) if limited else '0',
+    }
+    saved = {key: os.environ.get(key) for key in settings}
+    os.environ.update(settings)
+    try:
+        setup_rate_limiting(app)
+    finally:
+        for key, value in saved.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+    return app
+
+
+def run(app):
+    latencies, statuses, lock = [], Counter(), threading.Lock()
+    deadline = time.monotonic() + DURATION
+
+    def client(index):
+        http = app.test_client()
+        while time.monotonic() < deadline:
+            started = time.perf_counter()
+            response = http.get('/people', environ_base={'REMOTE_ADDR': f"10.0.0.{index % 8}"})
+            elapsed = time.perf_counter() - started
+            with lock:
+                statuses[response.status_code] += 1
+                if response.status_code == 200:
+                    latencies.append(elapsed)
+            if response.status_code != 200:
+                # misbehaving clients: retry far sooner than Retry-After asks to keep the overload
+                time.sleep(float(response.headers.get('Retry-After', 1)) / 100)
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(CLIENTS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sorted(latencies), statuses
+
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(len(values) * fraction))] * 1000
+
+
+if __name__ == '__main__':
+    for label, limited in (("without admission control", False), ("with admission control", True)):
+        latencies, statuses = run(make_app(limited))
+        print(f"{label}: served={statuses[200]} 429={statuses[429]} 503={statuses[503]} "
+              f"p50={percentile(latencies, 0.5):.1f}ms p99={percentile(latencies, 0.99):.1f}ms "
+              f"max={percentile(latencies, 1.0):.1f}ms")
@@ -2,6 +2,7 @@ import os
 from flask_admin import Admin
 from models import db, User, People, Planet, Favorite
 from flask_admin.contrib.sqla import ModelView
+from profiling import ProfilesView
 
 def setup_admin(app):
     app.secret_key = os.environ.get('FLASK_APP_KEY', 'sample key')
@@ -14,6 +15,7 @@ def setup_admin(app):
     admin.add_view(ModelView(People, db.session))
     admin.add_view(ModelView(Planet, db.session))
     admin.add_view(ModelView(Favorite, db.session))
+    admin.add_view(ProfilesView(name='Profiles', endpoint='profiles'))
 
     # You can duplicate that line to add mew models
     # admin.add_view(ModelView(YourModelName, db.session))
\ No newline at end of file
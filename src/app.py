@@ -2,28 +2,42 @@
 This module takes care of starting the API Server, Loading the DB and Adding the endpoints
 """
 import os
-from flask import Flask, request, jsonify, url_for
+from flask import Flask, request, jsonify, url_for, g
 from flask_migrate import Migrate
 from flask_swagger import swagger
 from flask_cors import CORS
+from werkzeug.middleware.proxy_fix import ProxyFix
 from utils import APIException, generate_sitemap
 from admin import setup_admin
+from commands import setup_commands
+from ratelimit import setup_rate_limiting
+from profiling import setup_profiling
 from models import db, User, People, Planet, Favorite
+from batch import parse_batch, run_batch
 
 app = Flask(__name__)
 app.url_map.strict_slashes = False
 
+# proxies in front of the app (1 on Render/Heroku), so request.remote_addr is the real client
+proxy_hops = int(os.getenv("PROXY_TRUSTED_HOPS", 0))
+if proxy_hops > 0:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=proxy_hops, x_proto=proxy_hops)
+
 db_url = os.getenv("DATABASE_URL")
 if db_url is not None:
     app.config['SQLALCHEMY_DATABASE_URI'] = db_url.replace("postgres://", "postgresql://")
 else:
     app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite:////tmp/test.db"
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['BATCH_MAX_REQUESTS'] = int(os.getenv("BATCH_MAX_REQUESTS", 50))
 
 MIGRATE = Migrate(app, db)
 db.init_app(app)
 CORS(app)
 setup_admin(app)
+setup_commands(app)
+setup_rate_limiting(app)
+setup_profiling(app)
 
 # Handle/serialize errors like a JSON object
 @app.errorhandler(APIException)
@@ -365,6 +379,20 @@ def delete_favorite_planet(planet_id):
     return jsonify({"message": "Favorite removed successfully"}), 200
 
 
+@app.route('/batch', methods=['POST'])
+def batch():
+    """POST /batch - Ejecutar varias peticiones en una sola llamada"""
+    if g.get('in_batch'):
+        raise APIException("Batches cannot be nested", status_code=400)
+    items = parse_batch(app, request.json, app.config['BATCH_MAX_REQUESTS'])
+
+    # forward the caller headers except the ones describing the batch body itself
+    headers = [(key, value) for key, value in request.headers
+               if key.lower() not in ('content-type', 'content-length')]
+
+    return jsonify(run_batch(app, items, headers, request.remote_addr)), 200
+
+
 # this only runs if `$ python src/app.py` is executed
 if __name__ == '__main__':
     PORT = int(os.environ.get('PORT', 3000))
@@ -0,0 +1,333 @@
+"""
+This module adds the flask commands that run outside of the API but against the same database
+
+    $ pipenv run bulk_import people ./people.ndjson
+"""
+import io
+import os
+import csv
+import json
+import time
+import itertools
+from datetime import datetime, timezone
+import click
+from sqlalchemy import Boolean, Integer, Enum, UniqueConstraint, PrimaryKeyConstraint, select, text
+from models import db, User, People, Planet, Favorite
+
+IMPORT_MODELS = {'people': People, 'planets': Planet, 'users': User, 'favorites': Favorite}
+
+# names are unique for the API (POST /people, POST /planets) even if the schema allows duplicates
+UNIQUE_NAMES = {'people': [('name',)], 'planets': [('name',)]}
+
+# Favorite.favorite_id points to a different table depending on favorite_type
+FAVORITE_TARGETS = {'people': 'people', 'planet': 'planets'}
+
+TRUE_VALUES = ('1', 'true', 't', 'yes', 'y')
+SHOWN_ERRORS = 10
+DECODE_LOOKAHEAD = 32
+
+
+def needs_more_data(error, buffer):
+    """Whether a decode error comes from an item cut by the end of the buffer: the decoder
+    stops within a few characters of the end (numbers, literals, escapes) or reports the
+    start of a string that is still open"""
+    return error.pos >= len(buffer) - DECODE_LOOKAHEAD or error.msg.startswith('Unterminated string')
+
+
+def read_json_array(file, chunk_size):
+    """Yield (position, item) for the items of a top level JSON array reading the file in chunks"""
+    decoder = json.JSONDecoder()
+    buffer = file.read(chunk_size).lstrip()
+    if not buffer.startswith('['):
+        raise click.ClickException("A JSON dump must contain an array of objects, use --format ndjson for one object per line")
+    position = 1
+    number = 0
+
+    while True:
+        while position < len(buffer) and (buffer[position].isspace() or buffer[position] == ','):
+            position += 1
+        if position < len(buffer) and buffer[position] == ']':
+            return
+        try:
+            if position == len(buffer):
+                raise json.JSONDecodeError("Need more data", buffer, position)
+            item, position = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError as error:
+            chunk = file.read(chunk_size) if needs_more_data(error, buffer) else None
+            if not chunk:
+                # a broken item leaves no reliable place to carry on from
+                raise click.ClickException(f"The JSON dump is malformed at item {number + 1}: {error.msg}")
+            buffer = buffer[position:] + chunk
+            position = 0
+            continue
+        number += 1
+        yield f"Item {number}", item
+
+
+def read_ndjson(file):
+    for number, line in enumerate(file, start=1):
+        if not line.strip():
+            continue
+        try:
+            yield f"Line {number}", json.loads(line)
+        except json.JSONDecodeError as error:
+            yield f"Line {number}", ValueError(f"malformed JSON, {error.msg}")
+
+
+def read_csv(file):
+    reader = csv.DictReader(file)
+    for row in reader:
+        yield f"Line {reader.line_num}", row
+
+
+def read_rows(file, fmt, chunk_size):
+    """Yield (position, row) pairs. Rows that cannot be parsed come as a ValueError,
+    so they are skipped and reported like any other invalid row"""
+    if fmt == 'csv':
+        return read_csv(file)
+    if fmt == 'ndjson':
+        return read_ndjson(file)
+    return read_json_array(file, chunk_size)
+
+
+def batches(rows, size):
+    iterator = iter(rows)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def make_converter(column):
+    """Returns the function turning a raw dump value into the value stored in `column`,
+    resolved once per column so the per-row work stays small"""
+    name = column.name
+    enums = column.type.enums if isinstance(column.type, Enum) else None
+    length = getattr(column.type, 'length', None)
+
+    def to_bool(value):
+        return value.strip().lower() in TRUE_VALUES if isinstance(value, str) else bool(value)
+
+    def to_int(value):
+        try:
+            return int(value)
+        except ValueError:
+            raise ValueError(f"{name} must be an integer")
+
+    def to_str(value):
+        value = str(value)
+        if enums is not None and value not in enums:
+            raise ValueError(f"{name} must be one of {', '.join(enums)}")
+        if length is not None and len(value) > length:
+            raise ValueError(f"{name} is longer than {length} characters")
+        return value
+
+    if isinstance(column.type, Boolean):
+        return to_bool
+    if isinstance(column.type, Integer):
+        return to_int
+    return to_str
+
+
+class RowChecker:
+    """Validates, deduplicates and checks the foreign keys of the rows in memory,
+    preloading the keys that are already in the database"""
+
+    def __init__(self, model_name, table):
+        self.created_at = datetime.now(timezone.utc).replace(tzinfo=None).isoformat(sep=' ')
+        self.with_ids = None
+        self.insert_columns = None
+        self.duplicates = 0
+        self.invalid = 0
+
+        self.fields = []
+        for column in table.columns:
+            if column.name == 'created_at':
+                continue
+            default = column.default.arg if column.default is not None and not column.default.is_callable else None
+            required = not column.nullable and not column.primary_key
+            self.fields.append((column.name, make_converter(column), default, required))
+
+        keys = [tuple(column.name for column in constraint.columns) for constraint in table.constraints
+                if isinstance(constraint, (UniqueConstraint, PrimaryKeyConstraint))]
+        keys += [(column.name,) for column in table.columns if column.unique]
+        keys += UNIQUE_NAMES.get(model_name, [])
+        self.seen = {}
+        for key in dict.fromkeys(keys):
+            query = select(*[table.c[name] for name in key])
+            self.seen[key] = set(tuple(row) for row in db.session.execute(query))
+
+        self.foreign_keys = [(column.name, fk.column.table.name) for column in table.columns for fk in column.foreign_keys]
+        targets = [target for _, target in self.foreign_keys]
+        if model_name == 'favorites':
+            targets += FAVORITE_TARGETS.values()
+        self.existing_ids = {
+            target: set(db.session.execute(select(db.metadata.tables[target].c.id)).scalars()) for target in targets
+        }
+
+    def check(self, row):
+        """Returns the values to insert, or None if the row is a duplicate"""
+        if not isinstance(row, dict):
+            raise ValueError("each row must be an object")
+
+        values = {}
+        for name, converter, default, required in self.fields:
+            value = row.get(name)
+            value = default if value is None or value == '' else converter(value)
+            if value is None and required:
+                raise ValueError(f"{name} is required")
+            values[name] = value
+
+        has_id = values.get('id') is not None
+        if self.with_ids is None:
+            self.with_ids = has_id
+            names = [name for name, _, _, _ in self.fields if name != 'id' or has_id]
+            self.insert_columns = names + ['created_at']
+        elif self.with_ids != has_id:
+            raise ValueError("either every row or no row must have an id")
+
+        for name, target in self.foreign_keys:
+            if values[name] not in self.existing_ids[target]:
+                raise ValueError(f"{name} {values[name]} does not exist in {target}")
+        if 'favorite_type' in values:
+            target = FAVORITE_TARGETS[values['favorite_type']]
+            if values['favorite_id'] not in self.existing_ids[target]:
+                raise ValueError(f"favorite_id {values['favorite_id']} does not exist in {target}")
+
+        row_keys = [(key, tuple([values[name] for name in key])) for key in self.seen]
+        for key, value in row_keys:
+            if value in self.seen[key] and None not in value:
+                self.duplicates += 1
+                return None
+        for key, value in row_keys:
+            self.seen[key].add(value)
+
+        values['created_at'] = self.created_at
+        return tuple([values[name] for name in self.insert_columns])
+
+    def valid_rows(self, rows):
+        for position, row in rows:
+            try:
+                if isinstance(row, ValueError):
+                    raise row
+                values = self.check(row)
+            except (ValueError, TypeError) as error:
+                self.invalid += 1
+                if self.invalid <= SHOWN_ERRORS:
+                    click.echo(f"{position} skipped: {error}", err=True)
+                continue
+            if values is not None:
+                yield values
+
+
+def copy_rows(cursor, table_name, columns, rows):
+    # COPY ... FORMAT csv reads unquoted empty fields as NULL
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+    cursor.copy_expert(f"COPY {table_name} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buffer)
+
+
+def insert_rows(cursor, table_name, columns, rows):
+    placeholder = '?' if db.engine.dialect.paramstyle == 'qmark' else '%s'
+    placeholders = ', '.join([placeholder] * len(columns))
+    cursor.executemany(f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES ({placeholders})", rows)
+
+
+def drop_table_indexes(table_name):
+    """Drop the unique constraints and secondary indexes of a PostgreSQL table (the primary
+    key stays) and return the statements that recreate them. Uniqueness is checked in memory
+    by RowChecker while they are gone"""
+    quote = db.engine.dialect.identifier_preparer.quote
+    restore = []
+    with db.engine.begin() as connection:
+        constraints = connection.execute(text(
+            "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+            "WHERE conrelid = CAST(:table AS regclass) AND contype = 'u'"
+        ), {'table': table_name}).all()
+        indexes = connection.execute(text(
+            "SELECT indexname, indexdef FROM pg_indexes WHERE schemaname = current_schema() AND tablename = :table "
+            "AND indexname NOT IN (SELECT conname FROM pg_constraint WHERE conrelid = CAST(:table AS regclass))"
+        ), {'table': table_name}).all()
+
+        for name, definition in constraints:
+            connection.exec_driver_sql(f"ALTER TABLE {quote(table_name)} DROP CONSTRAINT {quote(name)}")
+            restore.append(f"ALTER TABLE {quote(table_name)} ADD CONSTRAINT {quote(name)} {definition}")
+        for name, definition in indexes:
+            connection.exec_driver_sql(f"DROP INDEX {quote(name)}")
+            restore.append(definition)
+    return restore
+
+
+def restore_indexes(statements):
+    try:
+        with db.engine.begin() as connection:
+            for statement in statements:
+                connection.exec_driver_sql(statement)
+    except Exception as error:
+        raise click.ClickException(f"Could not recreate the indexes ({error}), run by hand: " + "; ".join(statements))
+
+
+def setup_commands(app):
+
+    @app.cli.command('bulk-import')
+    @click.argument('model', type=click.Choice(sorted(IMPORT_MODELS)))
+    @click.argument('path', type=click.Path(exists=True, dir_okay=False))
+    @click.option('--format', 'fmt', type=click.Choice(['json', 'ndjson', 'csv']),
+                  help="Dump format, guessed from the file extension by default.")
+    @click.option('--batch-size', default=50000, show_default=True,
+                  help="Rows sent per COPY / executemany call and committed per transaction.")
+    @click.option('--chunk-size', default=1 << 20, show_default=True,
+                  help="Characters read from the file at a time.")
+    @click.option('--drop-indexes', is_flag=True,
+                  help="PostgreSQL only: drop the unique constraints and secondary indexes of the table "
+                       "during the load and recreate them afterwards.")
+    def bulk_import(model, path, fmt, batch_size, chunk_size, drop_indexes):
+        """Load a JSON, NDJSON or CSV dump into people, planets, users or favorites"""
+        table = IMPORT_MODELS[model].__table__
+        if fmt is None:
+            extension = os.path.splitext(path)[1].lower()
+            fmt = {'.csv': 'csv', '.ndjson': 'ndjson', '.jsonl': 'ndjson'}.get(extension, 'json')
+
+        dialect = db.engine.dialect
+        if drop_indexes and dialect.name != 'postgresql':
+            raise click.ClickException("--drop-indexes is only supported on PostgreSQL, "
+                                       "other databases cannot drop the indexes behind UNIQUE constraints")
+        table_name = dialect.identifier_preparer.quote(table.name)
+        write_rows = copy_rows if dialect.name == 'postgresql' else insert_rows
+        checker = RowChecker(model, table)
+        db.session.close()
+
+        restore = drop_table_indexes(table.name) if drop_indexes else []
+
+        loaded = 0
+        started = time.perf_counter()
+        connection = db.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            with open(path, newline='', encoding='utf-8') as file:
+                for batch in batches(checker.valid_rows(read_rows(file, fmt, chunk_size)), batch_size):
+                    columns = [dialect.identifier_preparer.quote(name) for name in checker.insert_columns]
+                    write_rows(cursor, table_name, columns, batch)
+                    connection.commit()
+                    loaded += len(batch)
+                    elapsed = time.perf_counter() - started
+                    click.echo(f"{loaded:,} rows loaded ({loaded / elapsed:,.0f} rows/s)")
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            connection.close()
+            if restore:
+                restore_indexes(restore)
+
+        if dialect.name == 'postgresql' and checker.with_ids:
+            db.session.execute(text(
+                f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), (SELECT MAX(id) FROM {table_name}))"
+            ))
+            db.session.commit()
+
+        elapsed = time.perf_counter() - started
+        click.echo(f"Imported {loaded:,} {model} in {elapsed:.1f}s ({loaded / max(elapsed, 1e-9):,.0f} rows/s), "
+                   f"{checker.duplicates:,} duplicates and {checker.invalid:,} invalid rows skipped")
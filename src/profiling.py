@@ -0,0 +1,208 @@
+"""
+This module adds an opt-in stack sampling profiler around the request lifecycle.
+
+A request is profiled when it is picked by PROFILE_SAMPLE_RATE (0.0 - 1.0) or when it
+carries a valid X-Profile-Signature header. The header is "<expires>.<signature>", where
+<expires> is a unix timestamp in seconds and <signature> the hex HMAC-SHA256 of
+"<expires>:<request path>" with PROFILE_SECRET as key. Once <expires> has passed the
+header is refused, so a signature seen in a log stops working. To make one valid for
+ten minutes:
+
+    $ python -c "import time, hmac, hashlib; e = int(time.time()) + 600; \
+        print(f'{e}.' + hmac.new(b'<PROFILE_SECRET>', f'{e}:/people'.encode(), hashlib.sha256).hexdigest())"
+
+Each profile is written to PROFILE_DIR both as collapsed stacks (flamegraph.pl,
+speedscope) and as a speedscope JSON file.
+When neither PROFILE_SAMPLE_RATE nor PROFILE_SECRET is set no hook is registered at all.
+"""
+import os
+import re
+import sys
+import hmac
+import json
+import time
+import random
+import hashlib
+import threading
+from collections import Counter
+from html import escape
+from flask import current_app, g, request, send_from_directory
+from flask_admin import BaseView, expose
+
+SIGNATURE_HEADER = 'X-Profile-Signature'
+
+# <timestamp ms>_<endpoint>_<duration>ms, as written by write_profile()
+PROFILE_NAME = re.compile(r'^(\d+)_(.+)_(\d+ms)$')
+
+
+class StackSampler(threading.Thread):
+    """Samples the stack of one thread every `interval` seconds until stopped"""
+
+    def __init__(self, thread_id, interval):
+        threading.Thread.__init__(self, daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.finished = threading.Event()
+        self.started_at = time.perf_counter()
+        self.duration = 0.0
+
+    def run(self):
+        while not self.finished.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self.duration = time.perf_counter() - self.started_at
+        self.finished.set()
+        self.join()
+
+
+def sign_path(secret, path, expires):
+    message = f"{expires}:{path}"
+    return hmac.new(secret.encode(), message.encode(), hashlib.sha256).hexdigest()
+
+
+def valid_signature(header, secret, path):
+    expires, _, signature = header.partition(".")
+    if not (expires.isascii() and expires.isdigit()) or int(expires) < time.time():
+        return False
+    return hmac.compare_digest(signature, sign_path(secret, path, expires))
+
+
+def should_profile(config):
+    header = request.headers.get(SIGNATURE_HEADER)
+    if header and config['PROFILE_SECRET']:
+        return valid_signature(header, config['PROFILE_SECRET'], request.path)
+    return random.random() < config['PROFILE_SAMPLE_RATE']
+
+
+def to_speedscope(sampler, name):
+    frames, frame_index, samples, weights = [], {}, [], []
+    interval_ms = sampler.interval * 1000
+    for stack, count in sampler.stacks.items():
+        sample = []
+        for frame in stack.split(";"):
+            if frame not in frame_index:
+                frame_index[frame] = len(frames)
+                frames.append({"name": frame})
+            sample.append(frame_index[frame])
+        samples.append(sample)
+        weights.append(count * interval_ms)
+
+    return {
+        "$schema": "https://www.speedscope.app/file-format-schema.json",
+        "name": name,
+        "exporter": "src/profiling.py",
+        "shared": {"frames": frames},
+        "profiles": [{
+            "type": "sampled",
+            "name": name,
+            "unit": "milliseconds",
+            "startValue": 0,
+            "endValue": sum(weights),
+            "samples": samples,
+            "weights": weights,
+        }],
+    }
+
+
+def write_profile(config, sampler, endpoint, name):
+    directory = config['PROFILE_DIR']
+    os.makedirs(directory, exist_ok=True)
+    base = f"{int(time.time() * 1000)}_{endpoint}_{round(sampler.duration * 1000)}ms"
+
+    with open(os.path.join(directory, base + ".collapsed"), "w") as collapsed:
+        for stack, count in sampler.stacks.most_common():
+            collapsed.write(f"{stack} {count}\n")
+    with open(os.path.join(directory, base + ".speedscope.json"), "w") as speedscope:
+        json.dump(to_speedscope(sampler, name), speedscope)
+
+    for old in list_profiles(directory)[config['PROFILE_KEEP']:]:
+        for filename in (old + ".collapsed", old + ".speedscope.json"):
+            try:
+                os.remove(os.path.join(directory, filename))
+            except FileNotFoundError:
+                pass
+
+
+def list_profiles(directory):
+    """Profile base names, newest first. Other files in the directory are ignored"""
+    if not os.path.isdir(directory):
+        return []
+    names = [f[:-len(".collapsed")] for f in os.listdir(directory) if f.endswith(".collapsed")]
+    names = [name for name in names if PROFILE_NAME.match(name)]
+    return sorted(names, key=lambda name: int(name.partition("_")[0]), reverse=True)
+
+
+def setup_profiling(app):
+    app.config['PROFILE_SAMPLE_RATE'] = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+    app.config['PROFILE_SECRET'] = os.environ.get('PROFILE_SECRET')
+    app.config['PROFILE_DIR'] = os.environ.get('PROFILE_DIR', '/tmp/profiles')
+    app.config['PROFILE_INTERVAL_MS'] = float(os.environ.get('PROFILE_INTERVAL_MS', 2))
+    app.config['PROFILE_KEEP'] = int(os.environ.get('PROFILE_KEEP', 100))
+
+    # disabled: leave the request lifecycle untouched so there is no per-request cost
+    if app.config['PROFILE_SAMPLE_RATE'] <= 0 and not app.config['PROFILE_SECRET']:
+        return
+
+    @app.before_request
+    def start_profiler():
+        # sub-requests of /batch share the app context, they belong to the outer profile
+        if g.get('profiler') is not None or not should_profile(app.config):
+            return
+        sampler = StackSampler(threading.get_ident(), app.config['PROFILE_INTERVAL_MS'] / 1000)
+        g.profiler = sampler
+        request.environ['profiler'] = sampler
+        sampler.start()
+
+    @app.teardown_request
+    def stop_profiler(error=None):
+        sampler = request.environ.pop('profiler', None)
+        if sampler is None:
+            return
+        g.profiler = None
+        sampler.stop()
+        try:
+            write_profile(app.config, sampler, request.endpoint or 'unknown',
+                          f"{request.method} {request.full_path.rstrip('?')}")
+        except OSError:
+            app.logger.exception("Could not write profile for %s", request.path)
+
+
+class ProfilesView(BaseView):
+    """Admin page listing the most recent request profiles"""
+
+    @expose('/')
+    def index(self):
+        directory = current_app.config.get('PROFILE_DIR', '/tmp/profiles')
+        rows = []
+        for name in list_profiles(directory):
+            timestamp, endpoint, duration = PROFILE_NAME.match(name).groups()
+            taken = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(int(timestamp) / 1000))
+            collapsed = self.get_url('.download', filename=name + ".collapsed")
+            speedscope = self.get_url('.download', filename=name + ".speedscope.json")
+            rows.append(
+                f"<tr><td>{taken}</td><td>{escape(endpoint)}</td><td>{escape(duration)}</td>"
+                f"<td><a href='{collapsed}'>collapsed</a> | <a href='{speedscope}'>speedscope</a></td></tr>"
+            )
+
+        if not rows:
+            rows.append("<tr><td colspan='4'>No profiles yet. Set PROFILE_SAMPLE_RATE or PROFILE_SECRET to enable profiling.</td></tr>")
+        return """
+            <div style="padding: 20px;">
+            <h2>Recent request profiles</h2>
+            <p><a href="/admin/">Back to admin</a> - open the speedscope files at <a href="https://www.speedscope.app" target="_blank">speedscope.app</a></p>
+            <table border="1" cellpadding="5">
+            <tr><th>Taken at</th><th>Endpoint</th><th>Duration</th><th>Files</th></tr>""" + "".join(rows) + "</table></div>"
+
+    @expose('/<path:filename>')
+    def download(self, filename):
+        directory = current_app.config.get('PROFILE_DIR', '/tmp/profiles')
+        return send_from_directory(directory, filename, as_attachment=True)
@@ -0,0 +1,160 @@
+"""
+This module adds admission control in front of the API endpoints.
+
+Every client IP address gets a token bucket refilled at RATE_LIMIT_RATE tokens per
+second up to RATE_LIMIT_BURST. List reads, point reads and
+writes cost a different number of tokens. On top of that each endpoint only runs
+RATE_LIMIT_CONCURRENCY requests at the same time. Requests over either limit are
+rejected right away (429 / 503 with Retry-After) instead of queueing for a worker.
+
+The concurrency cap is counted per worker process. gunicorn's default sync workers
+serve one request at a time, so the cap only does something with threaded workers
+(the Procfile runs `--threads 4`): keep RATE_LIMIT_CONCURRENCY below the thread count.
+
+Both limits are off by default. Turn them on with RATE_LIMIT_RATE (for example 20) and
+RATE_LIMIT_CONCURRENCY, and when the app runs behind a proxy set PROXY_TRUSTED_HOPS so
+clients are told apart by their own address instead of the proxy's.
+"""
+import os
+import math
+import time
+import threading
+from flask import current_app, request, jsonify
+from utils import APIException
+from batch import PREPAID_READ, parse_batch, coalesced_reads
+
+EXEMPT_ENDPOINTS = ('static', 'sitemap')
+WRITE_METHODS = ('POST', 'PUT', 'PATCH', 'DELETE')
+
+
+class MemoryBucketStore:
+    """Token buckets kept in the worker process.
+
+    To share the buckets between workers plug in any object with the same `take()`
+    method, for example one backed by Redis.
+    """
+
+    def __init__(self, max_clients=10000):
+        self.max_clients = max_clients
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def take(self, key, cost, rate, burst):
+        """Take `cost` tokens from the bucket of `key`.
+        Returns 0 when admitted, otherwise the seconds until enough tokens are available."""
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            if tokens >= cost:
+                self.buckets[key] = (tokens - cost, now)
+                wait = 0
+            else:
+                self.buckets[key] = (tokens, now)
+                wait = (cost - tokens) / rate
+            if len(self.buckets) > self.max_clients:
+                self.prune(now, rate, burst)
+        return wait
+
+    def prune(self, now, rate, burst):
+        # a bucket that has refilled completely is the same as a missing one
+        self.buckets = {
+            key: (tokens, updated) for key, (tokens, updated) in self.buckets.items()
+            if tokens + (now - updated) * rate < burst
+        }
+        # still too many active clients: forget the least recently seen half, so the
+        # next prune only happens after max_clients / 2 new clients
+        if len(self.buckets) > self.max_clients // 2:
+            recent = sorted(self.buckets.items(), key=lambda item: item[1][1], reverse=True)
+            self.buckets = dict(recent[:self.max_clients // 2])
+
+
+def client_key():
+    # the user_id sent by the routes is not authenticated, keying on it would let
+    # a client pick a fresh bucket on every request or drain somebody else's
+    return f"ip:{request.remote_addr}"
+
+
+def request_cost(config):
+    if request.endpoint == 'batch':
+        # /batch loads every point read with its prefetch before running the sub-requests,
+        # so they are paid here and skip the bucket later (the other sub-requests pay on their own)
+        items = parse_batch(current_app, request.get_json(silent=True), config['BATCH_MAX_REQUESTS'])
+        cost = config['RATE_LIMIT_COST_POINT'] * coalesced_reads(current_app, items)
+        if cost > config['RATE_LIMIT_BURST']:
+            raise APIException("This batch has more point reads than the rate limit allows at once, "
+                               "split it in smaller batches", status_code=400)
+        return cost
+    if request.method in WRITE_METHODS:
+        return config['RATE_LIMIT_COST_WRITE']
+    if request.view_args:
+        return config['RATE_LIMIT_COST_POINT']
+    return config['RATE_LIMIT_COST_LIST']
+
+
+def reject(status_code, message, retry_after):
+    return jsonify({"error": message}), status_code, {'Retry-After': str(max(1, math.ceil(retry_after)))}
+
+
+def setup_rate_limiting(app, store=None):
+    app.config['RATE_LIMIT_RATE'] = float(os.environ.get('RATE_LIMIT_RATE', 0))
+    app.config['RATE_LIMIT_BURST'] = float(os.environ.get('RATE_LIMIT_BURST', 100))
+    app.config['RATE_LIMIT_COST_LIST'] = float(os.environ.get('RATE_LIMIT_COST_LIST', 10))
+    app.config['RATE_LIMIT_COST_POINT'] = float(os.environ.get('RATE_LIMIT_COST_POINT', 1))
+    app.config['RATE_LIMIT_COST_WRITE'] = float(os.environ.get('RATE_LIMIT_COST_WRITE', 5))
+    app.config['RATE_LIMIT_CONCURRENCY'] = int(os.environ.get('RATE_LIMIT_CONCURRENCY', 0))
+
+    rate = app.config['RATE_LIMIT_RATE']
+    burst = app.config['RATE_LIMIT_BURST']
+    concurrency = app.config['RATE_LIMIT_CONCURRENCY']
+    if rate <= 0 and concurrency <= 0:
+        return
+    for name in ('RATE_LIMIT_COST_LIST', 'RATE_LIMIT_COST_POINT', 'RATE_LIMIT_COST_WRITE'):
+        if rate > 0 and app.config[name] > burst:
+            raise ValueError(f"{name} cannot be larger than RATE_LIMIT_BURST, the request could never be admitted")
+
+    store = store if store is not None else MemoryBucketStore()
+    slots = {}
+    slots_lock = threading.Lock()
+
+    def endpoint_slots(endpoint):
+        with slots_lock:
+            if endpoint not in slots:
+                slots[endpoint] = threading.BoundedSemaphore(concurrency)
+            return slots[endpoint]
+
+    @app.before_request
+    def admit_request():
+        # admin views live in blueprints, unmatched urls have no endpoint,
+        # CORS preflights are answered without reaching the views
+        if request.method == 'OPTIONS' or request.endpoint is None or request.blueprint is not None \
+                or request.endpoint in EXEMPT_ENDPOINTS:
+            return
+
+        # worked out first: an invalid /batch body raises and must not leave a slot taken
+        cost = None
+        if rate > 0 and not request.environ.get(PREPAID_READ):
+            cost = request_cost(app.config)
+
+        # per process: only reachable when the worker runs several threads
+        slot = None
+        if concurrency > 0:
+            slot = endpoint_slots(request.endpoint)
+            if not slot.acquire(blocking=False):
+                return reject(503, "Server busy, try again later", 1)
+
+        if cost is not None:
+            wait = store.take(client_key(), cost, rate, burst)
+            if wait > 0:
+                if slot is not None:
+                    slot.release()
+                return reject(429, "Too many requests", wait)
+
+        if slot is not None:
+            request.environ['ratelimit.slot'] = slot
+
+    @app.teardown_request
+    def release_slot(error=None):
+        slot = request.environ.pop('ratelimit.slot', None)
+        if slot is not None:
+            slot.release()